@@ -0,0 +1,157 @@
+import math
+import torch
+from cfgen.data.utils import collate_batch
+
+def dense_dataset_nbytes(dataset):
+    """Estimate the memory needed to hold a dataset densely as float32 tensors.
+
+    Args:
+        dataset (RNAseqLoader): Dataset with sparse expression matrices.
+
+    Returns:
+        int: Number of bytes of the dense X and normalized X tensors.
+    """
+    nbytes = 0
+    for mod in dataset.modality_list:
+        n_copies = 2 if mod in dataset.normalized_modalities else 1  # X_norm is a separate tensor only if normalized
+        nbytes += n_copies * dataset.X[mod].shape[0] * dataset.X[mod].shape[1] * 4
+    return nbytes
+
+def fits_in_device_memory(dataset, device, fraction=0.5):
+    """Check if a dataset can be preloaded into the free memory of a CUDA device.
+
+    Args:
+        dataset (RNAseqLoader): Dataset with sparse expression matrices.
+        device (str): Device the model is trained on.
+        fraction (float, optional): Maximum fraction of the free device memory to use. Defaults to 0.5.
+
+    Returns:
+        bool: True if the dense dataset fits into the given fraction of free device memory.
+    """
+    if device != "cuda":
+        return False
+    free_memory, _ = torch.cuda.mem_get_info()
+    return dense_dataset_nbytes(dataset) < fraction * free_memory
+
+def _apply_to_batch(batch, fn, memo):
+    """Apply a function to all the tensors of a nested batch dictionary, once per tensor object."""
+    if isinstance(batch, dict):
+        return {key: _apply_to_batch(value, fn, memo) for key, value in batch.items()}
+    if id(batch) not in memo:
+        memo[id(batch)] = fn(batch)
+    return memo[id(batch)]
+
+def _concat_batches(batches, memo):
+    """Concatenate the tensors of a list of nested batch dictionaries, once per tensor object of the first batch."""
+    first = batches[0]
+    if isinstance(first, dict):
+        return {key: _concat_batches([batch[key] for batch in batches], memo) for key in first}
+    if id(first) not in memo:
+        memo[id(first)] = torch.cat(batches)
+    return memo[id(first)]
+
+class DeviceDataLoader:
+    """Data loader serving batches from dataset tensors preloaded into device memory."""
+    def __init__(self, dataset, indices, batch_size, shuffle, drop_last, device, chunk_size=10_000):
+        """
+        Initialize the DeviceDataLoader.
+
+        Args:
+            dataset (RNAseqLoader): Dataset providing batches through __getitems__.
+            indices (list): Indices of the observations served by the loader.
+            batch_size (int): Batch size.
+            shuffle (bool): Whether to reshuffle the observations at every epoch.
+            drop_last (bool): Whether to drop the last incomplete batch.
+            device (str): Device the tensors are moved to.
+            chunk_size (int, optional): Number of observations densified on the host at a time. Defaults to 10,000.
+        """
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.device = device
+        self.n_obs = len(indices)
+
+        # Materialize the observations chunk by chunk so that only one dense chunk lives on the host,
+        # tensors shared between X and X_norm are moved and concatenated only once
+        indices = list(indices)
+        chunks = [_apply_to_batch(dataset.__getitems__(indices[i:(i+chunk_size)]), lambda x: x.to(self.device), {})
+                  for i in range(0, self.n_obs, chunk_size)]
+        self.data = _concat_batches(chunks, {})
+        del chunks
+
+    def __iter__(self):
+        """
+        Iterate over batches indexed directly on the device.
+
+        Yields:
+            dict: Dictionary containing batched X (gene expression), X_norm and y (covariates).
+        """
+        if self.shuffle:
+            order = torch.randperm(self.n_obs, device=self.device)
+        else:
+            order = torch.arange(self.n_obs, device=self.device)
+        for i in range(len(self)):
+            idx = order[(i*self.batch_size):((i+1)*self.batch_size)]
+            yield _apply_to_batch(self.data, lambda x: x.index_select(0, idx), {})
+
+    def __len__(self):
+        """
+        Get the number of batches per epoch.
+
+        Returns:
+            int: Number of batches.
+        """
+        if self.drop_last:
+            return self.n_obs // self.batch_size
+        return math.ceil(self.n_obs / self.batch_size)
+
+def init_dataloaders(dataset, train_data, valid_data, training_config, device):
+    """Initialize the training and validation loaders, served from device memory if requested and the dense
+    dataset fits, from a DataLoader otherwise.
+
+    Args:
+        dataset (RNAseqLoader): Full dataset.
+        train_data (Subset): Training split of the dataset.
+        valid_data (Subset): Validation split of the dataset.
+        training_config (dict): Training configuration with batch_size, num_workers and preload_to_device.
+        device (str): Device the model is trained on.
+
+    Returns:
+        tuple: Training and validation data loaders.
+    """
+    # Serve batches from device memory if requested and the dense dataset fits, skipping the DataLoader
+    if training_config.preload_to_device and fits_in_device_memory(dataset, device):
+        print("Preload the dataset into device memory...")
+        train_dataloader = DeviceDataLoader(dataset,
+                                            train_data.indices,
+                                            batch_size=training_config.batch_size,
+                                            shuffle=True,
+                                            drop_last=True,
+                                            device=device)
+        
+        valid_dataloader = DeviceDataLoader(dataset,
+                                            valid_data.indices,
+                                            batch_size=training_config.batch_size,
+                                            shuffle=False,
+                                            drop_last=True,
+                                            device=device)
+    else:
+        # Initialize the data loaders, workers are kept alive across epochs and batches are pinned for GPU transfer
+        num_workers = training_config.num_workers
+        dataloader_kwargs = dict(num_workers=num_workers,
+                                 pin_memory=torch.cuda.is_available(),
+                                 persistent_workers=num_workers > 0,
+                                 prefetch_factor=4 if num_workers > 0 else None,
+                                 collate_fn=collate_batch)
+        train_dataloader = torch.utils.data.DataLoader(train_data,
+                                                       batch_size=training_config.batch_size,
+                                                       shuffle=True,
+                                                       drop_last=True,
+                                                       **dataloader_kwargs)
+        
+        valid_dataloader = torch.utils.data.DataLoader(valid_data,
+                                                       batch_size=training_config.batch_size,
+                                                       shuffle=False,
+                                                       drop_last=True,
+                                                       **dataloader_kwargs)
+    return train_dataloader, valid_dataloader
@@ -1,4 +1,6 @@
 import numpy as np
+import pandas as pd
+import scipy.sparse as sp
 import scanpy as sc
 import muon as mu
 import torch
@@ -30,6 +32,9 @@ class RNAseqLoader:
 
         self.is_binarized = is_binarized
         
+        # Modalities normalized on access: only log-normalization if ATAC not binarized
+        self.normalized_modalities = set() if self.is_binarized else {"atac"}
+        
         # Read adata
         adata_mu = mu.read(str(data_path))
         if hasattr(adata_mu, "mod"):
@@ -49,16 +54,22 @@ class RNAseqLoader:
             if layer_key not in adata[mod].layers:
                 adata[mod].layers[layer_key] = adata[mod].X.copy()
         
-        # Transform X into a tensor
+        # Keep X as a sparse CSR matrix, rows are densified in __getitem__
         self.X = {}
         for mod in self.modality_list:
-            self.X[mod] = torch.Tensor(adata[mod].layers[layer_key].todense())
+            X_mod = sp.csr_matrix(adata[mod].layers[layer_key])
+            # Integer counts fitting in 16 bits are stored as uint16, rows are upcast to float32 on access
+            if X_mod.nnz > 0 and np.all(X_mod.data >= 0) and X_mod.data.max() <= np.iinfo(np.uint16).max \
+                    and np.array_equal(X_mod.data, np.round(X_mod.data)):
+                self.X[mod] = X_mod.astype(np.uint16)
+            else:
+                self.X[mod] = X_mod.astype(np.float32)
 
         # Subsample if required
         if subsample_frac < 1:
             np.random.seed(42)
-            n_to_keep = int(subsample_frac*len(self.X["rna"]))
-            indices = np.random.choice(range(len(self.X["rna"])), n_to_keep, replace=False)
+            n_to_keep = int(subsample_frac*self.X["rna"].shape[0])
+            indices = np.random.choice(range(self.X["rna"].shape[0]), n_to_keep, replace=False)
             for mod in self.modality_list:
                 self.X[mod] = self.X[mod][indices]
                 adata[mod] = adata[mod][indices]  
@@ -68,23 +79,36 @@ class RNAseqLoader:
         self.Y_cov = {}   # cov: cov_ids
         adata_obs = adata["rna"].obs
         for cov_name in covariate_keys:
-            cov = np.array(adata_obs[cov_name])
-            unique_cov = np.unique(cov)
-            zip_cov_cat = dict(zip(unique_cov, np.arange(len(unique_cov))))  
+            # Categorical codes over the observed categories in sorted order
+            cov = pd.Categorical(adata_obs[cov_name]).remove_unused_categories()
+            cov = cov.reorder_categories(np.sort(cov.categories))
+            zip_cov_cat = dict(zip(cov.categories, np.arange(len(cov.categories))))  
             self.id2cov[cov_name] = zip_cov_cat
-            self.Y_cov[cov_name] = torch.tensor([zip_cov_cat[c] for c in cov])
+            self.Y_cov[cov_name] = torch.from_numpy(cov.codes.astype(np.int64))
+        
+        # Per-cell size factors computed with a single sparse row-sum per modality
+        self.size_factor = {}
+        for mod in self.modality_list:
+            self.size_factor[mod] = torch.from_numpy(np.asarray(self.X[mod].sum(1), dtype=np.float32).ravel())
+        
+        # Reuse the covariate codes for the grouped size factor statistics
+        cov_codes = {cov: self.Y_cov[cov].numpy() for cov in self.Y_cov}
         
         # Compute mean, standard deviation, maximum and minimum size factor - dictionary only if non-binarized multimodal 
         if not self.is_binarized:
             self.log_size_factor_mu, self.log_size_factor_sd, self.max_size_factor, self.min_size_factor = {},{},{},{}
             for mod in self.modality_list:
                 # Compute size factor for both RNA and Poisson ATAC
-                self.log_size_factor_mu[mod], self.log_size_factor_sd[mod] = compute_size_factor_lognorm(adata[mod], layer_key, self.id2cov)
-                log_size_factors = torch.log(self.X[mod].sum(1))
+                self.log_size_factor_mu[mod], self.log_size_factor_sd[mod] = compute_size_factor_lognorm(adata[mod], layer_key, self.id2cov,
+                                                                                                         row_sums=self.size_factor[mod].numpy(),
+                                                                                                         cov_codes=cov_codes)
+                log_size_factors = torch.log(self.size_factor[mod])
                 self.max_size_factor[mod], self.min_size_factor[mod] = log_size_factors.max(), log_size_factors.min()
         else:
-            self.log_size_factor_mu, self.log_size_factor_sd = compute_size_factor_lognorm(adata["rna"], layer_key, self.id2cov)
-            log_size_factors = torch.log(self.X["rna"].sum(1))
+            self.log_size_factor_mu, self.log_size_factor_sd = compute_size_factor_lognorm(adata["rna"], layer_key, self.id2cov,
+                                                                                           row_sums=self.size_factor["rna"].numpy(),
+                                                                                           cov_codes=cov_codes)
+            log_size_factors = torch.log(self.size_factor["rna"])
             self.max_size_factor, self.min_size_factor = log_size_factors.max(), log_size_factors.min()
                 
         del adata
@@ -105,10 +129,32 @@ class RNAseqLoader:
         X = {}
         X_norm = {}
         for mod in self.modality_list:
-            X[mod] = self.X[mod][i]
-            # Only log-normalization if ATAC not binarized
-            if mod == "atac" and (not self.is_binarized):
-                X_norm[mod] = normalize_expression(X[mod], X[mod].sum(), self.normalization_type)
+            X[mod] = torch.from_numpy(self.X[mod][i].toarray().ravel().astype(np.float32))
+            if mod in self.normalized_modalities:
+                X_norm[mod] = normalize_expression(X[mod], self.size_factor[mod][i], self.normalization_type)
+            else:
+                X_norm[mod] = X[mod]
+        return dict(X=X, X_norm=X_norm, y=y)
+
+    def __getitems__(self, indices):
+        """
+        Get a batch of items from the dataset with a single slice per field.
+
+        Args:
+            indices (list): Indices of the batch.
+
+        Returns:
+            dict: Dictionary containing batched X (gene expression) and y (covariates).
+        """
+        # Covariate
+        y = {cov: self.Y_cov[cov][indices] for cov in self.Y_cov}
+        # Return sampled cells
+        X = {}
+        X_norm = {}
+        for mod in self.modality_list:
+            X[mod] = torch.from_numpy(self.X[mod][indices].toarray().astype(np.float32))
+            if mod in self.normalized_modalities:
+                X_norm[mod] = normalize_expression(X[mod], self.size_factor[mod][indices].unsqueeze(1), self.normalization_type)
             else:
                 X_norm[mod] = X[mod]
         return dict(X=X, X_norm=X_norm, y=y)
@@ -120,4 +166,4 @@ class RNAseqLoader:
         Returns:
             int: Length of the dataset.
         """
-        return len(self.X["rna"])
\ No newline at end of file
+        return self.X["rna"].shape[0]
\ No newline at end of file
@@ -1,10 +1,34 @@
+import numpy as np
+import pandas as pd
 import torch
+from torch.utils.data import default_collate
 
-def normalize_expression(X, size_factor, normalization_type):
+def _normalize_sparse_csr(X, size_factor, normalization_type):
+    """Normalize a sparse CSR tensor by transforming its non-zero values only, since all the
+    transformations map zero to zero.
+
+    Args:
+        X (torch.Tensor): Sparse CSR gene expression matrix of shape (n_cells, n_genes).
+        size_factor (torch.Tensor): Size factors of the rows, of shape (n_cells,) or (n_cells, 1).
+        normalization_type (str): Type of normalization, see normalize_expression.
+
+    Returns:
+        torch.Tensor: Normalized sparse CSR gene expression matrix.
+    """
+    crow_indices, col_indices, values = X.crow_indices(), X.col_indices(), X.values()
+    if normalization_type in ["proportions", "log_gexp_scaled"]:
+        # Expand the size factors to one entry per non-zero value
+        row_ids = torch.repeat_interleave(torch.arange(X.shape[0], device=X.device), crow_indices.diff())
+        values = values * size_factor.reshape(-1).reciprocal()[row_ids]
+    if normalization_type in ["log_gexp", "log_gexp_scaled"]:
+        values = torch.log1p(values)
+    return torch.sparse_csr_tensor(crow_indices, col_indices, values, X.size())
+
+def normalize_expression(X, size_factor, normalization_type, inplace=False, dtype=None):
     """Normalize gene expression data based on the specified encoder type.
 
     Args:
-        X (torch.Tensor): Input gene expression matrix.
+        X (torch.Tensor): Input gene expression matrix, dense or sparse CSR.
         size_factor (torch.Tensor): Size factors for normalization.
         normalization_type (str): Type of encoder for normalization. It can be one of the following:
                             - "proportions": Normalize by dividing by size factor.
@@ -12,30 +36,44 @@ def normalize_expression(X, size_factor, normalization_type):
                             - "learnt_encoder": Apply log transformation to gene expression data.
                             - "learnt_autoencoder": Apply log transformation to gene expression data.
                             - "log_gexp_scaled": Apply log transformation after scaling by size factor.
+        inplace (bool, optional): Whether to overwrite a dense X instead of allocating the output. Only safe
+            outside of autograd, e.g. during data preprocessing. Defaults to False.
+        dtype (torch.dtype, optional): Dtype to compute the normalization in, e.g. torch.bfloat16 to halve the
+            memory traffic. Defaults to None, in which case the dtype of X is used.
 
     Returns:
-        torch.Tensor: Normalized gene expression data.
+        torch.Tensor: Normalized gene expression data, in the layout of the input.
 
     Raises:
         NotImplementedError: If the encoder type is not recognized.
     """
+    if dtype is not None:
+        X, size_factor = X.to(dtype), size_factor.to(dtype)
+    if X.layout == torch.sparse_csr and normalization_type in ["proportions", "log_gexp", "log_gexp_scaled"]:
+        return _normalize_sparse_csr(X, size_factor, normalization_type)
     if normalization_type == "proportions":
-        X = X / size_factor
+        # One reciprocal per cell, then a multiplication per element instead of a division
+        inv_size_factor = size_factor.reciprocal()
+        X = X.mul_(inv_size_factor) if inplace else X * inv_size_factor
     elif normalization_type == "log_gexp":
-        X = torch.log1p(X)
+        X = X.log1p_() if inplace else torch.log1p(X)
     elif normalization_type == "log_gexp_scaled":
-        X = torch.log1p(X / size_factor)
+        X = X.mul_(size_factor.reciprocal()).log1p_() if inplace else torch.log1p(X * size_factor.reciprocal())
     else:
         raise NotImplementedError(f"Encoder type '{normalization_type}' is not implemented.")
     return X
 
-def compute_size_factor_lognorm(adata, layer, id2cov):
+def compute_size_factor_lognorm(adata, layer, id2cov, row_sums=None, cov_codes=None):
     """Compute the mean and variance of the log size factors for each covariate category.
 
     Args:
         adata (AnnData): Annotated data matrix.
         layer (str): Name of the layer containing the gene expression data.
         id2cov (dict): Dictionary mapping covariate names to their categories.
+        row_sums (np.ndarray, optional): Precomputed per-cell counts of the layer. Defaults to None, in which case
+            they are computed from the layer.
+        cov_codes (dict, optional): Precomputed integer category codes per covariate name, following the order of
+            id2cov. Defaults to None, in which case they are derived from adata.obs.
 
     Returns:
         tuple: Two dictionaries containing the mean and standard deviation of the log size factors 
@@ -45,18 +83,39 @@ def compute_size_factor_lognorm(adata, layer, id2cov):
     """
     log_size_factors_mean, log_size_factors_sd = {}, {}
     
+    # Row sums of the layer, computed natively on the sparse matrix without densification
+    if row_sums is None:
+        row_sums = np.asarray(adata.layers[layer].sum(1), dtype=np.float32).ravel()
+    
+    log_row_sums = np.log(row_sums.astype(np.float64))
+    
     for cov_name in id2cov:
-        log_size_factors_mean_cov, log_size_factors_sd_cov = [], []
+        # Grouped reductions over the integer category codes replace one boolean mask per category
+        if cov_codes is not None:
+            codes = cov_codes[cov_name]
+        else:
+            codes = pd.Categorical(adata.obs[cov_name], categories=list(id2cov[cov_name])).codes
+        n_cats = len(id2cov[cov_name])
+        counts = np.bincount(codes, minlength=n_cats)
+        mean = np.bincount(codes, weights=log_row_sums, minlength=n_cats) / counts
+        # Unbiased variance from the centered values, as in torch.std
+        var = np.bincount(codes, weights=(log_row_sums - mean[codes])**2, minlength=n_cats) / (counts - 1)
         
-        for cov_cat in id2cov[cov_name]:
-            adata_cov = adata[adata.obs[cov_name] == cov_cat]
-            log_size_factors_cov = torch.log(torch.tensor(adata_cov.layers[layer].todense().sum(1)))
-            mean, sd = log_size_factors_cov.mean(), log_size_factors_cov.std()
-            
-            log_size_factors_mean_cov.append(mean)
-            log_size_factors_sd_cov.append(sd)
-        
-        log_size_factors_mean[cov_name] = torch.stack(log_size_factors_mean_cov)
-        log_size_factors_sd[cov_name] = torch.stack(log_size_factors_sd_cov)
+        log_size_factors_mean[cov_name] = torch.from_numpy(mean.astype(np.float32))
+        log_size_factors_sd[cov_name] = torch.from_numpy(np.sqrt(var).astype(np.float32))
     
     return log_size_factors_mean, log_size_factors_sd
+
+
+def collate_batch(batch):
+    """Collate function for batches returned by RNAseqLoader.__getitems__.
+
+    Args:
+        batch (dict or list): Either an already batched dictionary or a list of per-sample dictionaries.
+
+    Returns:
+        dict: Batched dictionary.
+    """
+    if isinstance(batch, dict):
+        return batch
+    return default_collate(batch)
@@ -8,6 +8,7 @@ from pytorch_lightning.callbacks import ModelCheckpoint, EarlyStopping
 from pytorch_lightning.loggers import WandbLogger
 from cfgen.paths import TRAINING_FOLDER
 from cfgen.data.scrnaseq_loader import RNAseqLoader
+from cfgen.data.device_loader import init_dataloaders
 from cfgen.models.featurizers.category_featurizer import CategoricalFeaturizer
 from cfgen.models.fm.denoising_model import MLPTimeStep
 from cfgen.models.fm.fm import FM
@@ -15,7 +16,6 @@ from cfgen.models.base.encoder_model import EncoderModel
 
 # Some general settings for the run
 os.environ["WANDB__SERVICE_WAIT"] = "300"
-torch.autograd.set_detect_anomaly(True)
 
 class CfgenEstimator:
     """Class for training and using the cfgen model."""
@@ -36,15 +36,16 @@ class CfgenEstimator:
         self.data_path = Path(self.args.dataset.dataset_path)
         self.is_binarized = self.args.encoder.is_binarized
         
-        # Initialize training directory         
+        # Initialize training directory, created only once training or testing starts
         self.training_dir = TRAINING_FOLDER / self.args.logger.project / self.unique_id
         self.plotting_dir = self.training_dir / "plots"
-        print("Create the training folders...")
-        self.training_dir.mkdir(parents=True, exist_ok=True)
-        self.plotting_dir.mkdir(exist_ok=True)
 
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         
+        # TF32 matmuls for the ops left in float32 by mixed precision, full float32 precision otherwise
+        if "mixed" in str(self.args.trainer.get("precision", "32")):
+            torch.set_float32_matmul_precision("high")
+        
         print("Initialize data module...")
         self.init_datamodule()  # Initialize the data module  
         self.get_fixed_rna_model_params()  # Initialize the data derived model params 
@@ -68,21 +69,15 @@ class CfgenEstimator:
                                     normalization_type=self.args.dataset.normalization_type,
                                     is_binarized=self.is_binarized)
 
-        # Initialize the data loaders 
         self.train_data, self.valid_data = random_split(self.dataset,
-                                                        lengths=self.args.dataset.split_rates)   
-        
-        self.train_dataloader = torch.utils.data.DataLoader(self.train_data,
-                                                            batch_size=self.args.training_config.batch_size,
-                                                            shuffle=True,
-                                                            num_workers=4, 
-                                                            drop_last=True)
+                                                        lengths=self.args.dataset.split_rates)
         
-        self.valid_dataloader = torch.utils.data.DataLoader(self.valid_data,
-                                                            batch_size=self.args.training_config.batch_size,
-                                                            shuffle=False,
-                                                            num_workers=4, 
-                                                            drop_last=True)
+        # Serve batches from device memory if requested and possible, from DataLoaders otherwise
+        self.train_dataloader, self.valid_dataloader = init_dataloaders(self.dataset,
+                                                                        self.train_data,
+                                                                        self.valid_data,
+                                                                        self.args.training_config,
+                                                                        self.device)
     
     def get_fixed_rna_model_params(self):
         """Set the model parameters extracted from the data loader object
@@ -124,19 +119,19 @@ class CfgenEstimator:
         """
         Initialize feature embeddings either for drugs or covariates 
         """
-        # Contains the embedding class of multiple feature types
-        self.feature_embeddings = {}  
+        # Contains the embedding class of multiple feature types, registered as submodules
+        self.feature_embeddings = torch.nn.ModuleDict()  
         self.num_classes = {}
                 
         for cov, cov_names in self.dataset.id2cov.items():
             self.feature_embeddings[cov] = CategoricalFeaturizer(len(cov_names), 
                                                                     self.args.dataset.one_hot_encode_features, 
-                                                                    self.device, 
                                                                     embedding_dimensions=self.args.denoising_module.embedding_dim)
             if self.args.dataset.one_hot_encode_features:
                 self.num_classes[cov] = len(cov_names)
             else:
                 self.num_classes[cov] = self.args.denoising_module.embedding_dim
+        self.feature_embeddings.to(self.device)
 
     def init_model(self):
         """Initialize the (optional) autoencoder and generative model 
@@ -164,10 +159,16 @@ class CfgenEstimator:
                                         conditional=self.args.denoising_module.conditional, 
                                         is_binarized=self.is_binarized, 
                                         modality_list=self.modality_list, 
-                                        guided_conditioning=self.args.denoising_module.guided_conditioning).to(self.device)
+                                        guided_conditioning=self.args.denoising_module.guided_conditioning, 
+                                        init_scale=self.args.denoising_module.init_scale).to(self.device)
         
         print("Denoising model", denoising_model)
         
+        # Optionally compile the denoising model in place, keeping the state dict keys unchanged.
+        # CUDA graphs are avoided since guided sampling reads the unconditional output after a second forward pass
+        if self.args.training_config.compile:
+            denoising_model.compile()
+        
         # Initialize encoder
         self.encoder_model = EncoderModel(in_dim=self.gene_dim,
                                           n_cat=self.feature_embeddings[self.args.dataset.theta_covariate].n_cat,
@@ -202,10 +203,19 @@ class CfgenEstimator:
             **self.args.generative_model  # model_kwargs should contain the rest of the arguments
             )
 
+    def _ensure_training_dirs(self):
+        """
+        Create the training and plotting folders if they do not exist yet.
+        """
+        print("Create the training folders...")
+        self.training_dir.mkdir(parents=True, exist_ok=True)
+        self.plotting_dir.mkdir(exist_ok=True)
+
     def train(self):
         """
         Train the generative model using the provided trainer.
         """
+        self._ensure_training_dirs()
         self.trainer_generative.fit(
             self.generative_model,
             train_dataloaders=self.train_dataloader,
@@ -215,6 +225,7 @@ class CfgenEstimator:
         """
         Test the generative model.
         """
+        self._ensure_training_dirs()
         self.trainer_generative.test(
             self.generative_model,
             dataloaders=self.valid_dataloader)
@@ -8,11 +8,11 @@ from pytorch_lightning.callbacks import ModelCheckpoint, EarlyStopping
 from pytorch_lightning.loggers import WandbLogger
 from cfgen.paths import TRAINING_FOLDER
 from cfgen.data.scrnaseq_loader import RNAseqLoader
+from cfgen.data.device_loader import init_dataloaders
 from cfgen.models.base.encoder_model import EncoderModel
  
 # Some general settings for the run
 os.environ["WANDB__SERVICE_WAIT"] = "300"
-torch.autograd.set_detect_anomaly(True)
 
 class EncoderEstimator:
     """Class for training and using the cfgen model."""
@@ -33,10 +33,8 @@ class EncoderEstimator:
         # dataset path as Path object 
         self.data_path = Path(self.args.dataset.dataset_path)
         
-        # Initialize training directory         
+        # Initialize training directory, created only once training or testing starts
         self.training_dir = TRAINING_FOLDER / self.args.logger.project / self.unique_id
-        print("Create the training folders...")
-        self.training_dir.mkdir(parents=True, exist_ok=True)
 
         # Set device for training
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -71,18 +69,12 @@ class EncoderEstimator:
         self.train_data, self.valid_data = random_split(self.dataset,
                                                         lengths=self.args.dataset.split_rates)   
         
-        # Initialize the data loaders for training and validation
-        self.train_dataloader = torch.utils.data.DataLoader(self.train_data,
-                                                            batch_size=self.args.training_config.batch_size,
-                                                            shuffle=True,
-                                                            num_workers=4, 
-                                                            drop_last=True)
-        
-        self.valid_dataloader = torch.utils.data.DataLoader(self.valid_data,
-                                                            batch_size=self.args.training_config.batch_size,
-                                                            shuffle=False,
-                                                            num_workers=4, 
-                                                            drop_last=True)
+        # Serve batches from device memory if requested and possible, from DataLoaders otherwise
+        self.train_dataloader, self.valid_dataloader = init_dataloaders(self.dataset,
+                                                                        self.train_data,
+                                                                        self.valid_data,
+                                                                        self.args.training_config,
+                                                                        self.device)
     
     def get_fixed_rna_model_params(self):
         """Set the model parameters extracted from the data loader object.
@@ -125,10 +117,18 @@ class EncoderEstimator:
                                           **self.args.encoder)
         print("Encoder architecture", self.encoder_model)
 
+    def _ensure_training_dirs(self):
+        """
+        Create the training folder if it does not exist yet.
+        """
+        print("Create the training folders...")
+        self.training_dir.mkdir(parents=True, exist_ok=True)
+
     def train(self):
         """
         Train the generative model using the provided trainer.
         """
+        self._ensure_training_dirs()
         # Train the model using the training and validation data loaders
         self.trainer_generative.fit(
             self.encoder_model,
@@ -139,6 +139,7 @@ class EncoderEstimator:
         """
         Test the generative model.
         """
+        self._ensure_training_dirs()
         # Test the model using the validation data loader
         self.trainer_generative.test(
             self.encoder_model,
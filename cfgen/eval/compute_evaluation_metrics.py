@@ -68,8 +68,8 @@ def compute_evaluation_metrics(adata_real,
     cell_type_metrics = {}
 
     # Compute Wasserstein distance and MMD metrics
-    mmd_wasserstein = compute_distribution_distances(torch.tensor(adata_real.obsm["X_pca"]).float(), 
-                                                     torch.tensor(adata_generated.obsm["X_pca"]).float())
+    mmd_wasserstein = compute_distribution_distances(torch.from_numpy(np.ascontiguousarray(adata_real.obsm["X_pca"], dtype=np.float32)), 
+                                                     torch.from_numpy(np.ascontiguousarray(adata_generated.obsm["X_pca"], dtype=np.float32)))
     for metric in mmd_wasserstein:
         cell_type_metrics[metric + "_PCA"] = mmd_wasserstein[metric]
     
@@ -38,8 +38,8 @@ def normalize_and_compute_metrics(adata_real, adata_fake, layer, sparse=True):
     
     # Normalize the data to the range [-1, 1]
     scaler = MinMaxScaler(feature_range=(-1, 1))
-    normalized_real = torch.tensor(scaler.fit_transform(X_real))
-    normalized_generated = torch.tensor(scaler.fit_transform(X_fake))
+    normalized_real = torch.from_numpy(scaler.fit_transform(X_real))
+    normalized_generated = torch.from_numpy(scaler.fit_transform(X_fake))
     
     # Compute distribution distances
     metrics = compute_distribution_distances(normalized_real, normalized_generated)
@@ -108,14 +108,14 @@ class EncoderModel(pl.LightningModule):
             loss (tensor): Loss value for the step.
 
         """
-        X = {mod: batch["X"][mod].to(self.device) for mod in batch["X"]}
+        X = {mod: batch["X"][mod].to(self.device, non_blocking=True) for mod in batch["X"]}
         size_factor = {}
         for mod in X:
             size_factor_mod = X[mod].sum(1).unsqueeze(1).to(self.device)
             size_factor[mod] = size_factor_mod
 
         # Conditioning covariate encodings
-        y = batch["y"][self.conditioning_covariate].to(self.device)
+        y = batch["y"][self.conditioning_covariate].to(self.device, non_blocking=True)
 
         # Make the encoding multimodal
         z = self.encode(batch)
@@ -197,7 +197,7 @@ class EncoderModel(pl.LightningModule):
         """
         z = {}
         for mod in self.modality_list:
-            z_mod = self.encoder[mod](batch["X_norm"][mod].to(self.device))
+            z_mod = self.encoder[mod](batch["X_norm"][mod].to(self.device, non_blocking=True))
             z[mod] = z_mod
             
         # Implement joint layers if defined
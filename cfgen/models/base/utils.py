@@ -12,7 +12,7 @@ def unsqueeze_right(x, num_dims=1):
     Returns:
         torch.Tensor: Tensor with unsqueezed dimensions.
     """
-    return x.view(x.shape + (1,) * num_dims)
+    return x[(..., *(None,) * num_dims)]
 
 def pad_t_like_x(t, x):
     """Function to reshape the time vector t by the number of dimensions of x.
@@ -5,7 +5,33 @@ from torch import nn
 
 from cfgen.models.fm.layer_utils import Linear
 
+# Names of the torch.nn normalization layers selected by name, any other name disables normalization.
+# Classes are looked up on use since nn.RMSNorm is only available from torch 2.4
+NORMALIZATIONS = {"layer": "LayerNorm",
+                  "batch": "BatchNorm1d",
+                  "rms": "RMSNorm"}
+
 # Util functions
+def normalization_layer(normalization, dim):
+    """
+    Instantiates the normalization layer selected by name.
+
+    Args:
+        normalization (str): Key of the normalization in NORMALIZATIONS.
+        dim (int): Number of features to normalize.
+
+    Returns:
+        torch.nn.Module: The normalization layer.
+
+    Raises:
+        NotImplementedError: If the normalization layer is not available in the installed torch version.
+    """
+    layer_name = NORMALIZATIONS[normalization]
+    if not hasattr(nn, layer_name):
+        raise NotImplementedError(f"Normalization '{normalization}' requires nn.{layer_name}, which is not available "
+                                  f"in torch {torch.__version__}.")
+    return getattr(nn, layer_name)(dim)
+
 def zero_init(module):
     """
     Initializes the weights and biases of a PyTorch module with zero values.
@@ -21,12 +47,56 @@ def zero_init(module):
         nn.init.constant_(module.bias.data, 0)
     return module
 
+def small_init(module, std):
+    """
+    Initializes the weights of a PyTorch module with small normal values and its biases with zero values.
+
+    Args:
+        module (torch.nn.Module): PyTorch module for weight and bias initialization.
+        std (float): Standard deviation of the normal distribution for the weights.
+
+    Returns:
+        torch.nn.Module: The input module with initialized weights and biases.
+    """
+    nn.init.normal_(module.weight.data, mean=0.0, std=std)
+    if hasattr(module, 'bias') and module.bias is not None:
+        nn.init.constant_(module.bias.data, 0)
+    return module
+
+def get_inv_timescales(
+    embedding_dim: int,
+    max_timescale=10_000,
+    min_timescale=1,
+    device=None,
+    ):
+    """
+    Computes the inverse timescales of the sinusoidal embedding.
+
+    Args:
+        embedding_dim (int): Dimensionality of the embedding. It must be an even number.
+        max_timescale (float, optional): Maximum timescale value for the sinusoidal embedding. Default is 10,000.
+        min_timescale (float, optional): Minimum timescale value for the sinusoidal embedding. Default is 1.
+        device (torch.device, optional): Device of the resulting tensor. Default is None.
+
+    Returns:
+        torch.Tensor: Inverse timescales of size embedding_dim // 2.
+    """
+    assert embedding_dim % 2 == 0
+    num_timescales = embedding_dim // 2
+    return torch.logspace(  # or exp(-linspace(log(min), log(max), n))
+        -np.log10(min_timescale),
+        -np.log10(max_timescale),
+        num_timescales,
+        device=device,
+    )
+
 def get_timestep_embedding(
     timesteps,
     embedding_dim: int,
     dtype=torch.float32,
     max_timescale=10_000,
     min_timescale=1,
+    inv_timescales=None,
     ):
     """
     Generates a sinusoidal embedding for a sequence of timesteps.
@@ -37,6 +107,8 @@ def get_timestep_embedding(
         dtype (torch.dtype, optional): Data type for the resulting tensor. Default is torch.float32.
         max_timescale (float, optional): Maximum timescale value for the sinusoidal embedding. Default is 10,000.
         min_timescale (float, optional): Minimum timescale value for the sinusoidal embedding. Default is 1.
+        inv_timescales (torch.Tensor, optional): Precomputed inverse timescales. Default is None, in which case
+            they are computed from max_timescale and min_timescale.
 
     Returns:
         torch.Tensor: Sinusoidal embedding tensor for the input timesteps with the specified embedding_dim.
@@ -44,14 +116,9 @@ def get_timestep_embedding(
     # Adapted from tensor2tensor and VDM codebase.
     assert timesteps.ndim == 1
     assert embedding_dim % 2 == 0
-    timesteps *= 1000.0  # In DDPM the time step is in [0, 1000], here [0, 1]
-    num_timescales = embedding_dim // 2
-    inv_timescales = torch.logspace(  # or exp(-linspace(log(min), log(max), n))
-        -np.log10(min_timescale),
-        -np.log10(max_timescale),
-        num_timescales,
-        device=timesteps.device,
-    )
+    timesteps = timesteps * 1000.0  # In DDPM the time step is in [0, 1000], here [0, 1]
+    if inv_timescales is None:
+        inv_timescales = get_inv_timescales(embedding_dim, max_timescale, min_timescale, device=timesteps.device)
     emb = timesteps.to(dtype)[:, None] * inv_timescales[None, :]  # (T, D/2)
     return torch.cat([emb.sin(), emb.cos()], dim=1)  # (T, D)
 
@@ -73,7 +140,8 @@ class MLPTimeStep(pl.LightningModule):
                  is_binarized=False, 
                  modality_list=None, 
                  conditioning_probability=0.8, 
-                 guided_conditioning=True):
+                 guided_conditioning=True, 
+                 init_scale=0.0):
         
         super().__init__()
         
@@ -95,6 +163,27 @@ class MLPTimeStep(pl.LightningModule):
         self.conditioning_probability = conditioning_probability  # Conditioning probability during the guiding 
         self.guided_conditioning = guided_conditioning
         
+        # Conditioning is specialized on the configuration once instead of branching at every forward
+        if not self.guided_conditioning:
+            self._embed_condition = self._embed_condition_all
+        elif self.conditional:
+            self._embed_condition = self._embed_condition_guided
+        else:
+            self._embed_condition = self._embed_no_condition
+        
+        # Inverse timescales of the sinusoidal embeddings, not part of the state dict
+        self.register_buffer("inv_timescales", get_inv_timescales(embedding_dim), persistent=False)
+        
+        # Min-max scaling of the log size factors as offset and scale, one entry per modality with a size factor
+        if not self.is_binarized:
+            size_factor_min = torch.stack([torch.as_tensor(size_factor_min[mod]) for mod in self.modality_list])
+            size_factor_max = torch.stack([torch.as_tensor(size_factor_max[mod]) for mod in self.modality_list])
+        else:
+            size_factor_min = torch.as_tensor(size_factor_min).view(1)
+            size_factor_max = torch.as_tensor(size_factor_max).view(1)
+        self.register_buffer("size_factor_offset", size_factor_min.float(), persistent=False)
+        self.register_buffer("size_factor_scale", 1 / (size_factor_max - size_factor_min).float(), persistent=False)
+        
         # Time embedding network
         self.time_embedder = nn.Sequential(
             Linear(embedding_dim, embedding_dim),  # Upsample embedding
@@ -111,62 +200,41 @@ class MLPTimeStep(pl.LightningModule):
         # Initial convolution
         self.net_in = Linear(in_dim, self.hidden_dim)
 
-        # Down path: n_blocks blocks with a resnet block and maybe attention.
-        self.blocks = []
-
-        # Dimensionality preserving Resnet in the bottleneck 
-        for _ in range(n_blocks):
-            self.blocks.append(ResnetBlock(in_dim=self.hidden_dim,
-                                                out_dim=self.hidden_dim,
-                                                dropout_prob=dropout_prob,
-                                                embedding_dim=embedding_dim,  
-                                                normalization=normalization))
-        
-        # Set up blocks
-        self.blocks = nn.ModuleList(self.blocks)
+        # Dimensionality preserving Resnet in the bottleneck: n_blocks resnet blocks
+        self.blocks = nn.ModuleList([ResnetBlock(in_dim=self.hidden_dim,
+                                                 out_dim=self.hidden_dim,
+                                                 dropout_prob=dropout_prob,
+                                                 embedding_dim=embedding_dim,  
+                                                 normalization=normalization, 
+                                                 init_scale=init_scale) for _ in range(n_blocks)])
         
-        if normalization not in ["layer", "batch"]:
+        if normalization not in NORMALIZATIONS:
             self.net_out = nn.Sequential(
                 nn.SiLU(),
                 Linear(self.hidden_dim, in_dim))
         else:
             self.net_out = nn.Sequential(
-                nn.LayerNorm(self.hidden_dim) if normalization=="layer" else nn.BatchNorm1d(num_features=self.hidden_dim),
+                normalization_layer(normalization, self.hidden_dim),
                 nn.SiLU(),
                 Linear(self.hidden_dim, in_dim))
 
     def forward(self, x, t, l, y, inference=False, unconditional=False, covariate=None):        
-        # Make a copy of time for using in time embeddings
-        t_for_embeddings = t.clone().detach().squeeze()
-        
-        # Time embedding   
-        emb = self.time_embedder(get_timestep_embedding(t_for_embeddings, self.embedding_dim))
+        # Time embedding, t is B or B x 1 and is not modified by the embedding
+        emb = self.time_embedder(get_timestep_embedding(t.view(-1), self.embedding_dim, inv_timescales=self.inv_timescales))
                 
         # Embed condition
-        if self.guided_conditioning:  
-            is_conditioned = torch.bernoulli(torch.tensor([self.conditioning_probability])).item() if not inference else 1. # Bernoulli variable to decide whether to condition or not
-            if self.conditional and is_conditioned and not unconditional:
-                if covariate == None:  
-                    covariate = np.random.choice(self.covariate_list)
-                emb = emb + y[covariate]
-        else:
-            # Normal conditioning 
-            for covariate in y:
-                emb = emb + y[covariate]
+        emb = self._embed_condition(emb, y, inference, unconditional, covariate)
     
         # Embed size factor
         if self.embed_size_factor:
+            # Stack the log size factors of all modalities as B x M and scale them in a single op
             if not self.is_binarized:
-                for mod in self.modality_list:
-                    l_mod = l[mod].squeeze()
-                    l_mod = (l_mod - self.size_factor_min[mod]) / (self.size_factor_max[mod] - self.size_factor_min[mod])
-                    l_mod = self.size_factor_embedder(get_timestep_embedding(l_mod, self.embedding_dim))
-                    emb = emb + l_mod
+                l = torch.cat([l[mod].view(-1, 1) for mod in self.modality_list], dim=1)
             else:
-                l = l.squeeze()
-                l = (l - self.size_factor_min) / (self.size_factor_max - self.size_factor_min)
-                l = self.size_factor_embedder(get_timestep_embedding(l, self.embedding_dim))
-                emb = emb + l        
+                l = l.view(-1, 1)
+            l = (l - self.size_factor_offset) * self.size_factor_scale
+            l = self.size_factor_embedder(get_timestep_embedding(l.flatten(), self.embedding_dim, inv_timescales=self.inv_timescales))
+            emb = emb + l.view(-1, self.size_factor_offset.shape[0], self.embedding_dim).sum(1)
 
         # Compute prediction
         h = self.net_in(x)  
@@ -174,6 +242,25 @@ class MLPTimeStep(pl.LightningModule):
             h = block(h, emb)
         pred = self.net_out(h)
         return pred 
+    
+    def _embed_condition_guided(self, emb, y, inference, unconditional, covariate):
+        """Add the embedding of one covariate, randomly dropped during training for guidance."""
+        is_conditioned = np.random.uniform() < self.conditioning_probability if not inference else True  # Bernoulli variable to decide whether to condition or not
+        if is_conditioned and not unconditional:
+            if covariate is None:  
+                covariate = np.random.choice(self.covariate_list)
+            emb = emb + y[covariate]
+        return emb
+    
+    def _embed_condition_all(self, emb, y, inference, unconditional, covariate):
+        """Add the embeddings of all covariates (normal conditioning)."""
+        for covariate in y:
+            emb = emb + y[covariate]
+        return emb
+    
+    def _embed_no_condition(self, emb, y, inference, unconditional, covariate):
+        """Leave the embedding unconditioned."""
+        return emb
 
 class ResnetBlock(nn.Module):
     """
@@ -185,6 +272,8 @@ class ResnetBlock(nn.Module):
         condition_dim (int, optional): Dimension of the conditional input. Defaults to None.
         dropout_prob (float, optional): Dropout probability. Defaults to 0.0.
         norm_groups (int, optional): Number of groups for layer normalization. Defaults to 32.
+        normalization (str, optional): Normalization layer, one of "layer", "batch" or "rms". Any other value disables normalization. Defaults to "batch".
+        init_scale (float, optional): Standard deviation of the initial weights of the last layer, zero initialization if 0. Defaults to 0.0.
     """
     def __init__(
         self,
@@ -192,7 +281,8 @@ class ResnetBlock(nn.Module):
         out_dim=None,
         dropout_prob=0.0,
         embedding_dim=None, 
-        normalization="batch"):
+        normalization="batch", 
+        init_scale=0.0):
         
         super().__init__()
                 
@@ -204,31 +294,34 @@ class ResnetBlock(nn.Module):
         self.out_dim = out_dim
 
         # First linear block with LayerNorm and SiLU activation
-        if normalization not in ["layer", "batch"]:
+        if normalization not in NORMALIZATIONS:
             self.net1 = nn.Sequential(
                 nn.SiLU(),
                 Linear(in_dim, out_dim))          
         else:
             self.net1 = nn.Sequential(
-                nn.LayerNorm(in_dim) if normalization=="layer" else nn.BatchNorm1d(num_features=in_dim),
+                normalization_layer(normalization, in_dim),
                 nn.SiLU(),
                 Linear(in_dim, out_dim))
         
         # Projections for conditions 
         self.cond_proj = nn.Sequential(nn.SiLU(), Linear(self.embedding_dim, out_dim))
             
+        # Last layer of the block, zero or small-scale initialized so that the block starts close to the identity
+        out_proj = zero_init(Linear(out_dim, out_dim)) if init_scale == 0 else small_init(Linear(out_dim, out_dim), init_scale)
+            
         # Second linear block with LayerNorm, SiLU activation, and optional dropout
-        if normalization not in ["layer", "batch"]:
+        if normalization not in NORMALIZATIONS:
             self.net2 = nn.Sequential(
                 nn.SiLU(),
                 *([nn.Dropout(dropout_prob)] * (dropout_prob > 0.0)),
-                zero_init(Linear(out_dim, out_dim)))
+                out_proj)
         else:
             self.net2 = nn.Sequential(
-                nn.LayerNorm(out_dim) if normalization=="layer" else nn.BatchNorm1d(num_features=out_dim),
+                normalization_layer(normalization, out_dim),
                 nn.SiLU(),
                 *([nn.Dropout(dropout_prob)] * (dropout_prob > 0.0)),
-                zero_init(Linear(out_dim, out_dim)))
+                out_proj)
 
         # Linear projection for skip connection if input_dim and output_dim differ
         if in_dim != out_dim:
@@ -245,12 +338,9 @@ class ResnetBlock(nn.Module):
         Returns:
             torch.Tensor: Output features.
         """
-        # Forward pass through the first linear block
-        h = self.net1(x)
-
-        # Condition time and library size 
-        emb = self.cond_proj(emb)           
-        h = h + emb
+        # Forward pass through the first linear block, conditioned on time and library size in place
+        # (the backward of the final Linear does not need its output)
+        h = self.net1(x).add_(self.cond_proj(emb))
                 
         # Forward pass through the second linear block
         h = self.net2(h)
@@ -259,8 +349,8 @@ class ResnetBlock(nn.Module):
         if x.shape[1] != self.out_dim:
             x = self.skip_proj(x)
 
-        # Add skip connection to the output
+        # Add skip connection to the output in place
         assert x.shape == h.shape
         
-        return x + h
+        return h.add_(x)
     
\ No newline at end of file
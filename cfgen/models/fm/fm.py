@@ -21,7 +21,7 @@ class FM(pl.LightningModule):
     def __init__(self,
                  encoder_model: nn.Module,
                  denoising_model: nn.Module,
-                 feature_embeddings: dict, 
+                 feature_embeddings: nn.ModuleDict, 
                  plotting_folder: Path,
                  in_dim: int,
                  size_factor_statistics: dict,
@@ -45,7 +45,7 @@ class FM(pl.LightningModule):
         
         Args:
             denoising_model (nn.Module): Denoising model.
-            feature_embeddings (dict): Feature embeddings for covariates.
+            feature_embeddings (nn.ModuleDict): Feature embeddings for covariates.
             x0_from_x_kwargs (dict): Arguments for the x0_from_x MLP.
             plotting_folder (Path): Folder for saving plots.
             in_dim (int): Number of genes.
@@ -119,16 +119,26 @@ class FM(pl.LightningModule):
         """
         # Collect observation and put onto device 
         x = batch["X"]  # counts
-        x = {mod: x[mod].to(self.device) for mod in x}  # move to device
+        x = {mod: x[mod].to(self.device, non_blocking=True) for mod in x}  # move to device
         
-        # Collect labels 
-        y_fea = self._featurize_batch_y(batch)
+        # Pick the covariate for guided conditioning outside the denoising model, only its embedding is needed
+        if self.denoising_model.guided_conditioning and self.denoising_model.conditional:
+            covariate = np.random.choice(self.covariate_list)
+            y_fea = {covariate: self.feature_embeddings[covariate](batch["y"][covariate])}
+        elif self.denoising_model.guided_conditioning:
+            # The unconditional model ignores the covariates
+            covariate = None
+            y_fea = None
+        else:
+            covariate = None
+            y_fea = self._featurize_batch_y(batch)
 
-        # Encode observations into the latent space
-        with torch.no_grad():
+        # Encode observations into the latent space, the frozen encoder runs in float32 outside mixed precision
+        with torch.no_grad(), torch.autocast(device_type=self.device.type, enabled=False):
             x0 = self.encoder_model.encode(batch)
             if not self.encoder_model.encoder_multimodal_joint_layers:
                 x0 = torch.cat([x0[mod] for mod in self.modality_list], dim=1)  # concatenate ordered by the modality list 
+            x0 = x0.float()
 
         # Quantify size factor 
         if self.is_binarized:
@@ -149,7 +159,7 @@ class FM(pl.LightningModule):
         t, x_t, u_t = self.sample_location_and_conditional_flow(z, x0, t)
 
         # Forward through the model 
-        v_t = self.denoising_model(x_t, t, log_size_factor, y_fea)
+        v_t = self.denoising_model(x_t, t, log_size_factor, y_fea, covariate=covariate)
         loss = self.criterion(u_t, v_t)  # (B, )
         
         # Save results
@@ -503,11 +513,8 @@ class FM(pl.LightningModule):
         Returns:
             dict: Optimizer configuration.
         """
+        # Feature embeddings are registered submodules and included in the parameters
         params = list(self.parameters())
-        
-        for covariate in self.feature_embeddings:
-            if not self.feature_embeddings[covariate].one_hot_encode_features:
-                params += list(self.feature_embeddings[covariate].parameters())
                  
         optimizer = torch.optim.AdamW(params, 
                                     self.learning_rate, 
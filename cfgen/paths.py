@@ -1,6 +1,8 @@
+import os
 from pathlib import Path
 
 ROOT = Path(__file__).parent.parent.resolve()
 
 DATA_DIR = ROOT / "project_folder" / "datasets"
-TRAINING_FOLDER = ROOT / "project_folder" / "experiments"
+# Checkpoints and logs can be redirected to fast local storage via the CFGEN_TRAINING_FOLDER environment variable
+TRAINING_FOLDER = Path(os.environ.get("CFGEN_TRAINING_FOLDER", ROOT / "project_folder" / "experiments"))